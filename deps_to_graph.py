@@ -2,13 +2,21 @@
 """Render Rosette API dependency parse trees as SVG via Graphviz"""
 
 import argparse
+import functools
+import hashlib
+import json
 import os
-import re
+import pickle
+import string
 import subprocess
 import sys
-import urllib
+import tempfile
+import threading
+import urllib.parse
 
-from operator import itemgetter, methodcaller
+from itertools import chain
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
 from getpass import getpass
 
 
@@ -28,17 +36,136 @@ If you are missing any of these modules, install them with pip3:
 
 DEFAULT_ROSETTE_API_URL = 'https://api.rosette.com/rest/v1/'
 
+# Input files larger than this many bytes are uploaded to the Rosette API as
+# multipart file uploads, which skips decoding them as UTF-8 and embedding
+# them in the JSON request body (the SDK still reads the whole file into
+# memory, and the cache reads it once more to hash it)
+UPLOAD_THRESHOLD = 1 << 20
+
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'rosette'
+)
+
+# Cache format name -> (is binary, load function, save function)
+CACHE_FORMATS = {
+    'json': (False, json.load, json.dump),
+    'pickle': (
+        True,
+        pickle.load,
+        functools.partial(pickle.dump, protocol=pickle.HIGHEST_PROTOCOL)
+    ),
+}
+
 ROOT = 'root'
-NODE = '{index} [label="{token}"]\n'
+# Characters that have special semantics within GraphViz mapped to their
+# backslash-escaped forms (str.translate avoids the regex engine per token)
+ESCAPES = str.maketrans({c: '\\' + c for c in '[]()"\\'})
 
-EDGE = '{governorTokenIndex} -> {dependencyTokenIndex} [label="{relationship}"]'
+# Characters that urllib.parse.quote(..., '/:') leaves untouched, i.e., a URI
+# consisting only of these does not need to be %-escaped
+URI_SAFE = frozenset(string.ascii_letters + string.digits + '_.-~/:')
 
 STYLE = '''
 edge [dir="forward", arrowhead="open", arrowsize=0.5]
 node [shape="box", height=0]
 '''
 
-def request(content, endpoint, api, language=None, uri=False, **kwargs):
+def cache_key(*args, **kwargs):
+    """Get a hex digest identifying a request with the given arguments"""
+    identity = json.dumps([args, kwargs], sort_keys=True, default=str)
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+def file_digest(path):
+    """Get a hex digest of a file's content without loading it all at once"""
+    digest = hashlib.sha256()
+    with open(path, mode='rb') as f:
+        for block in iter(functools.partial(f.read, 1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def read_cache(key, cache_format):
+    """Load a cached result, or get None if there is no usable entry"""
+    binary, load, _ = CACHE_FORMATS[cache_format]
+    path = os.path.join(CACHE_DIR, '{}.{}'.format(key, cache_format))
+    try:
+        with open(path, mode='rb' if binary else 'r') as f:
+            return load(f)
+    # A missing entry raises OSError, but a corrupt pickle can raise almost
+    # anything, and any unusable entry is simply a miss
+    except Exception:
+        return None
+
+def write_cache(key, cache_format, result):
+    """Save a result to the cache"""
+    binary, _, save = CACHE_FORMATS[cache_format]
+    path = os.path.join(CACHE_DIR, '{}.{}'.format(key, cache_format))
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Write to a temporary file and move it into place so that readers
+    # (e.g., other batch threads) never see a partially written entry and
+    # a crash never leaves a truncated one behind
+    with tempfile.NamedTemporaryFile(
+        mode='wb' if binary else 'w', dir=CACHE_DIR, delete=False
+    ) as f:
+        try:
+            save(result, f)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, path)
+
+def cached(request):
+    """Cache the JSON results of a request function on disk
+
+    Results are stored under CACHE_DIR, keyed by a hash of the content,
+    endpoint, language, any other request arguments and the api's service URL,
+    URL parameters and options (for uploads, the hash covers the file's content
+    rather than its path), so identical requests are only sent to the Rosette
+    API once.  Caching is off unless cache=True is passed to the decorated
+    function; pass cache_format='pickle' as well to store results as pickles,
+    which load faster than JSON (an existing JSON entry is converted rather
+    than requested again).  Requests for URIs are never cached, since the
+    content behind a URI can change.
+    """
+    @functools.wraps(request)
+    def wrapper(
+        content, endpoint, api, language=None, uri=False, upload=False,
+        cache=False, cache_format='json', **kwargs
+    ):
+        if not cache or uri:
+            return request(
+                content, endpoint, api, language, uri, upload, **kwargs
+            )
+        identity = file_digest(content) if upload else content
+        key = cache_key(
+            identity,
+            endpoint,
+            language,
+            upload,
+            api.service_url,
+            api.url_parameters,
+            api.options,
+            **kwargs
+        )
+        adm = read_cache(key, cache_format)
+        if adm is not None:
+            return adm
+        # The pickle cache complements the JSON cache, so reuse a JSON entry
+        # for the same request before asking the Rosette API again
+        if cache_format != 'json':
+            adm = read_cache(key, 'json')
+        if adm is None:
+            adm = request(
+                content, endpoint, api, language, uri, upload, **kwargs
+            )
+        write_cache(key, cache_format, adm)
+        return adm
+    return wrapper
+
+@cached
+def request(
+    content, endpoint, api, language=None, uri=False, upload=False, **kwargs
+):
     """Request Rosette API results for the given content and endpoint.
 
     This method gets the requested results from the Rosette API as JSON.  If
@@ -57,6 +184,13 @@ def request(content, endpoint, api, language=None, uri=False, **kwargs):
               content by default)
     uri:      specify that the content is to be treated as a URI and the
               the document content is to be extracted from the URI
+    upload:   specify that the content is the path of a local file to be
+              uploaded as raw bytes in a multipart request, rather than being
+              decoded and embedded in the JSON request body (the file is still
+              read into memory in full)
+    cache:    look the results up in (and save them to) the on-disk cache
+              in CACHE_DIR (default: False; URI requests are never cached)
+    cache_format: 'json' or 'pickle' (default: 'json')
     kwargs:   additional keyword arguments
               (e.g., if endpoint is 'morphology' you can specify facet='lemmas';
               see https://developer.rosette.com/features-and-functions for
@@ -165,97 +299,350 @@ def request(content, endpoint, api, language=None, uri=False, **kwargs):
     parameters = DocumentParameters()
     if uri:
         parameters['contentUri'] = content
+    elif upload:
+        parameters.load_document_file(content)
     else:
         parameters['content'] = content
-    parameters['language'] = language
-    adm = methodcaller(endpoint, parameters, **kwargs)(api)
+    # DocumentParameters already defaults the language to None (which the SDK
+    # leaves out when serializing), so only override it when one is given
+    if language is not None:
+        parameters['language'] = language
+    adm = getattr(api, endpoint)(parameters, **kwargs)
     return adm
 
+def request_many(contents, endpoint, api, language=None, **kwargs):
+    """Lazily request Rosette API results for each of an iterable of contents
+
+    This is like calling request for each content string, except that the
+    request parameters and the endpoint call are set up once and reused for
+    every content, which saves work when processing many documents.  Results
+    are not cached.  render_batch does not use this: its worker threads would
+    swap the content of the one shared parameters object out from under each
+    other's requests, and it needs request's caching and file uploads.
+
+    contents: an iterable of document content strings
+    endpoint, api, language and kwargs are as for request.
+
+    For example:
+
+    for adm in request_many(documents, 'syntax_dependencies', api):
+        print(deps_to_graph(adm))
+    """
+    parameters = DocumentParameters()
+    if language is not None:
+        parameters['language'] = language
+    call = functools.partial(getattr(api, endpoint), parameters, **kwargs)
+    for content in contents:
+        parameters['content'] = content
+        yield call()
+
+@functools.lru_cache(maxsize=8192)
 def escape(token):
-    """Escape characters that have special semantics within GraphViz"""
-    pattern = re.compile(r'([\[\]()"\\])')
-    return pattern.sub(r'\\\1', token)
+    """Escape characters that have special semantics within GraphViz
 
-def extent(obj):
-    """Get the start and end offset attributes of a dict-like object"""
-    return obj.get('startOffset', -1), obj.get('endOffset', -1)
+    Results are memoized since natural language text repeats the same tokens
+    over and over.
+    """
+    return token.translate(ESCAPES)
+
+# Get the start and end offset attributes of a dict-like object
+extent = itemgetter('startOffset', 'endOffset')
 
 def tokens(adm):
     """Get a sorted list of tokens from the ADM"""
     return sorted(adm['attributes']['token']['items'], key=extent)
 
 def dependencies(adm):
-    """Get a sorted list of dependency edges from the ADM"""
-    return sorted(
-        adm['attributes']['dependency']['items'],
-        key=itemgetter('governorTokenIndex', 'dependencyTokenIndex')
-    )
+    """Get a list of dependency edges from the ADM grouped by governor
+
+    Edges are bucketed by governor token index in a single linear pass (roots,
+    whose governor index is -1, come first) rather than sorted, since the order
+    of edges within a digraph does not affect rendering.
+    """
+    buckets = [[] for _ in range(len(adm['attributes']['token']['items']) + 1)]
+    for edge in adm['attributes']['dependency']['items']:
+        buckets[edge['governorTokenIndex'] + 1].append(edge)
+    return list(chain.from_iterable(buckets))
 
 def deps_to_graph(adm, index_labels=False):
-    """Create a digraph whose nodes are tokens and edges are dependencies"""
-    sentence_index = -1
-    digraph = 'digraph G{{{}'.format(STYLE)
-    for i, token in enumerate(tokens(adm)):
-        index_label = '({}) '.format(i) if index_labels else ''
-        token_text = '{}{}'.format(index_label, escape(token['text']))
-        digraph += NODE.format(index=i, token=token_text)
-    for edge in dependencies(adm):
-        if edge['relationship'] == ROOT:
-            digraph += '{} [label="S{}"]'.format(sentence_index, -sentence_index)
-            edge['governorTokenIndex'] = sentence_index
-            sentence_index -= 1
-        digraph += EDGE.format(**edge) + '\n'
-    digraph += '}\n'
-    return digraph
+    """Create a digraph whose nodes are tokens and edges are dependencies
 
-def make_svg(digraph):
-    """Get an SVG from a digraph string (relies on GraphViz)"""
+    Each root dependency is attached to a node for its sentence.  Sentence
+    nodes are numbered from 1 and have negative indices (-1, -2, ...) so that
+    they cannot collide with token indices.  The ADM is not modified.
+    """
+    # Collect the pieces in a list and join once at the end to avoid quadratic
+    # string concatenation on large parses
+    parts = ['digraph G{', STYLE]
+    # Nodes, sentences and edges are written with f-strings, which unlike
+    # str.format do not parse a format string for every line
+    if index_labels:
+        parts.extend(
+            f'{i} [label="({i}) {escape(token["text"])}"]\n'
+            for i, token in enumerate(tokens(adm))
+        )
+    else:
+        parts.extend(
+            f'{i} [label="{escape(token["text"])}"]\n'
+            for i, token in enumerate(tokens(adm))
+        )
+    edges = dependencies(adm)
+    governors = [edge['governorTokenIndex'] for edge in edges]
+    roots = (i for i, edge in enumerate(edges) if edge['relationship'] == ROOT)
+    for sentence, i in enumerate(roots, 1):
+        governors[i] = -sentence
+        parts.append(f'{-sentence} [label="S{sentence}"]\n')
+    parts.extend(
+        f'{governor} -> {edge["dependencyTokenIndex"]} '
+        f'[label="{edge["relationship"]}"]\n'
+        for governor, edge in zip(governors, edges)
+    )
+    parts.append('}\n')
+    return ''.join(parts)
+
+def spawn_dot(stderr=subprocess.PIPE):
+    """Start a dot process that reads digraphs on stdin and writes SVG
+
+    The process's pipes are binary: digraphs are written as UTF-8 encoded bytes
+    and SVGs are read back as UTF-8 encoded bytes.
+    """
     try:
-        process = subprocess.Popen(
+        return subprocess.Popen(
             ['dot', '-Tsvg'],
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
+            stderr=stderr,
+            # Move large digraphs and SVGs through the pipes in 64KB blocks
+            bufsize=1 << 16,
         )
     except OSError:
         message = '''Cannot find dot which is required to create the SVG.
 (You can install dot from the Graphviz package: http://graphviz.org/)'''
         raise Exception(message)
-    svg, stderr = process.communicate(digraph)
+
+def make_svg(digraph):
+    """Get a UTF-8 encoded SVG from a digraph string (relies on GraphViz)"""
+    process = spawn_dot()
+    svg, stderr = process.communicate(digraph.encode('utf-8'))
     if stderr:
-        print(stderr, file=sys.stderr)
+        print(stderr.decode('utf-8', 'replace'), file=sys.stderr)
         message = 'Failed to create an svg representation from string: {}'
         raise Exception(message.format(digraph))
     return svg
 
+class DotRenderer(object):
+    """A long-lived dot process that renders many digraphs as SVG
+
+    dot renders each graph it reads from stdin as soon as the graph is
+    complete, so a single process can be reused to render any number of
+    digraphs, saving a fork/exec of dot per graph.  Use it as a context manager
+    so that the dot process is shut down when rendering is finished:
+
+    with DotRenderer() as renderer:
+        svgs = [renderer.render(digraph) for digraph in digraphs]
+    """
+
+    def __init__(self):
+        # dot's diagnostics go to a file rather than a pipe so that a chatty
+        # dot can never block on a full stderr pipe that nobody is reading
+        self.stderr = tempfile.TemporaryFile()
+        self.process = spawn_dot(stderr=self.stderr)
+
+    def render(self, digraph):
+        """Get a UTF-8 encoded SVG from a digraph string"""
+        # Note where this graph's diagnostics (if any) will start
+        offset = self.stderr.tell()
+        self.process.stdin.write(digraph.encode('utf-8'))
+        self.process.stdin.flush()
+        lines = []
+        for line in iter(self.process.stdout.readline, b''):
+            lines.append(line)
+            if line.rstrip() == b'</svg>':
+                return b''.join(lines)
+        self.stderr.seek(offset)
+        print(self.stderr.read().decode('utf-8', 'replace'), file=sys.stderr)
+        message = 'Failed to create an svg representation from string: {}'
+        raise Exception(message.format(digraph))
+
+    def close(self):
+        """Shut down the dot process"""
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.process.wait()
+        self.stderr.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def make_svgs(digraphs):
+    """Lazily get SVGs for an iterable of digraph strings using one dot process
+    """
+    with DotRenderer() as renderer:
+        for digraph in digraphs:
+            yield renderer.render(digraph)
+
+def is_upload(content, uri=False):
+    """Check if content is a local file large enough to be uploaded as is"""
+    return (
+        not uri and
+        content is not None and
+        os.path.isfile(content) and
+        os.path.getsize(content) > UPLOAD_THRESHOLD
+    )
+
+class DotPool(object):
+    """DotRenderers shared by a pool of threads, one dot process per thread
+
+    Each thread renders with its own long-lived dot process, so digraphs can be
+    rendered in parallel without any fork/exec per graph:
+
+    with DotPool() as pool, ThreadPoolExecutor() as executor:
+        svgs = list(executor.map(pool.render, digraphs))
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.renderers = []
+
+    def render(self, digraph):
+        """Get a UTF-8 encoded SVG from a digraph using the thread's dot"""
+        renderer = getattr(self.local, 'renderer', None)
+        if renderer is None:
+            renderer = self.local.renderer = DotRenderer()
+            with self.lock:
+                self.renderers.append(renderer)
+        return renderer.render(digraph)
+
+    def close(self):
+        """Shut down all of the dot processes"""
+        with self.lock:
+            renderers, self.renderers = self.renderers, []
+        for renderer in renderers:
+            renderer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def decode(data):
+    """Decode UTF-8 bytes, translating newlines like a text mode read would"""
+    return data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+
 def get_content(content, uri=False):
     """Load content from file or stdin"""
+    # Read raw bytes in large blocks and decode once rather than going through
+    # the text layer's small chunked reads
     if content is None:
-        content = sys.stdin.read()
+        content = decode(sys.stdin.buffer.read())
     elif os.path.isfile(content):
-        with open(content, mode='r') as f:
-            content = f.read()
+        with open(content, mode='rb', buffering=1 << 20) as f:
+            content = decode(f.read())
     # Rosette API may balk at non-Latin characters in a URI so we can get urllib
-    # to %-escape the URI for us
-    if uri:
+    # to %-escape the URI for us (unless quoting would leave it unchanged)
+    if uri and not URI_SAFE.issuperset(content):
         unquoted = urllib.parse.unquote(content)
         content = urllib.parse.quote(unquoted, '/:')
     return content
 
+def batch_inputs(directory):
+    """Get the paths of the input files in a directory for batch processing
+
+    Hidden files (e.g., .DS_Store) are skipped, as are SVG files so that a
+    directory can hold its own results.
+    """
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if not name.startswith('.') and
+        not name.endswith('.svg') and
+        os.path.isfile(os.path.join(directory, name))
+    )
+
+def parse(
+    path, api, language=None, uri=False, cache=False, cache_format='json'
+):
+    """Get a syntactic dependencies ADM for input from a path, URI or stdin"""
+    upload = is_upload(path, uri)
+    content = path if upload else get_content(path, uri)
+    return request(
+        content,
+        'syntax_dependencies',
+        api,
+        language=language,
+        uri=uri,
+        upload=upload,
+        cache=cache,
+        cache_format=cache_format
+    )
+
+def render_batch(
+    paths, api, language=None, index_labels=False, cache=False,
+    cache_format='json', workers=1
+):
+    """Lazily get (path, SVG) pairs for many input files in parallel
+
+    The Rosette API requests and dot rendering for each path run on a pool of
+    up to workers threads, each with its own dot process.  Before starting
+    more than one worker, the Rosette API is pinged so that the SDK learns how
+    many concurrent requests the account allows, and the number of workers is
+    capped at that limit (requests beyond it would fail).  Results are yielded
+    in the same order as paths.  If any path fails, requests that have not
+    started yet are cancelled before the error is raised.
+    """
+
+    def render(path):
+        adm = parse(
+            path,
+            api,
+            language=language,
+            cache=cache,
+            cache_format=cache_format
+        )
+        return pool.render(deps_to_graph(adm, index_labels))
+
+    if workers > 1 and len(paths) > 1:
+        # The SDK only learns the account's limit from the headers of a plain
+        # request, which a cached or uploaded input would never make, so ask
+        # for it explicitly before any workers start
+        api.ping()
+        workers = min(workers, api.get_pool_size(), len(paths))
+    with DotPool() as pool:
+        executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+        futures = []
+        try:
+            futures.extend(executor.submit(render, path) for path in paths)
+            for path, future in zip(paths, futures):
+                yield path, future.result()
+        finally:
+            # Cancel whatever has not started yet by hand, since shutdown only
+            # takes cancel_futures from Python 3.9 on
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+
 def dump(data, filename):
+    """Write bytes (or str as UTF-8) to a file, or to stdout if no filename"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
     if filename is None:
-        print(data, file=sys.stdout)
+        sys.stdout.buffer.write(data)
     else:
-        with open(filename, mode='w') as f:
-            print(data, file=f)
+        with open(filename, mode='wb', buffering=1 << 20) as f:
+            f.write(data)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         description=__doc__
     )
-    parser.add_argument(
+    inputs = parser.add_mutually_exclusive_group()
+    inputs.add_argument(
         '-i', '--input',
         help=(
             'Path to a file containing input data (if not specified data is '
@@ -263,6 +650,16 @@ if __name__ == '__main__':
         ),
         default=None
     )
+    inputs.add_argument(
+        '--batch',
+        metavar='DIR',
+        help=(
+            'Path to a directory of input files to render in one batch; an '
+            'SVG named after each file is written to the output directory '
+            '(given by -o/--output, otherwise DIR)'
+        ),
+        default=None
+    )
     parser.add_argument(
         '-u',
         '--content-uri',
@@ -303,7 +700,36 @@ if __name__ == '__main__':
             'this can help in reading the trees, but it adds visual clutter'
         )
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help=(
+            'Number of inputs to process at once in batch mode (capped at the '
+            'number of concurrent requests your Rosette API plan allows)'
+        )
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help=(
+            'Always query the Rosette API rather than reusing cached results '
+            'from {}'.format(CACHE_DIR)
+        )
+    )
+    parser.add_argument(
+        '--pickle-cache',
+        action='store_true',
+        help=(
+            'Cache Rosette API results as pickles rather than JSON, which are '
+            'faster to load when re-rendering the same input'
+        )
+    )
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('argument --workers: must be at least 1')
+    if args.batch is not None and args.content_uri:
+        parser.error('argument -u/--content-uri: not allowed with --batch')
     # Get the user's Rosette API key
     key = (
         os.environ.get('ROSETTE_USER_KEY') or
@@ -313,12 +739,30 @@ if __name__ == '__main__':
     # Instantiate the Rosette API
     api = API(user_key=key, service_url=args.api_url)
     api.set_url_parameter('output', 'rosette')
-    content = get_content(args.input, args.content_uri)
-    adm = request(
-        content,
-        'syntax_dependencies',
-        api,
-        language=args.language,
-        uri=args.content_uri
-    )
-    dump(make_svg(deps_to_graph(adm, args.label_indices)), args.output)
+    cache = not args.no_cache
+    cache_format = 'pickle' if args.pickle_cache else 'json'
+    if args.batch is None:
+        adm = parse(
+            args.input,
+            api,
+            language=args.language,
+            uri=args.content_uri,
+            cache=cache,
+            cache_format=cache_format
+        )
+        dump(make_svg(deps_to_graph(adm, args.label_indices)), args.output)
+    else:
+        output = args.output or args.batch
+        os.makedirs(output, exist_ok=True)
+        svgs = render_batch(
+            batch_inputs(args.batch),
+            api,
+            language=args.language,
+            index_labels=args.label_indices,
+            cache=cache,
+            cache_format=cache_format,
+            workers=args.workers
+        )
+        for path, svg in svgs:
+            name = '{}.svg'.format(os.path.basename(path))
+            dump(svg, os.path.join(output, name))
@@ -0,0 +1,451 @@
+"""Tests for deps_to_graph.py (run with: python3 -m unittest)"""
+
+import copy
+import importlib.util
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+# deps_to_graph exits if the Rosette API bindings are missing
+if importlib.util.find_spec('rosette') is None:
+    raise unittest.SkipTest('rosette_api is not installed')
+
+import deps_to_graph
+
+# The ADM for 'This is a sentence. So is this.' with tokens and edges
+# deliberately out of order
+ADM = {
+    'attributes': {
+        'token': {
+            'items': [
+                {'startOffset': 5, 'endOffset': 7, 'text': 'is'},
+                {'startOffset': 0, 'endOffset': 4, 'text': 'This'},
+                {'startOffset': 8, 'endOffset': 9, 'text': 'a'},
+                {'startOffset': 10, 'endOffset': 18, 'text': 'sentence'},
+                {'startOffset': 18, 'endOffset': 19, 'text': '.'},
+                {'startOffset': 20, 'endOffset': 22, 'text': 'So'},
+                {'startOffset': 23, 'endOffset': 25, 'text': 'is'},
+                {'startOffset': 26, 'endOffset': 30, 'text': 'this'},
+                {'startOffset': 30, 'endOffset': 31, 'text': '.'},
+            ]
+        },
+        'dependency': {
+            'items': [
+                {
+                    'relationship': 'punct',
+                    'governorTokenIndex': 3,
+                    'dependencyTokenIndex': 4
+                },
+                {
+                    'relationship': 'nsubj',
+                    'governorTokenIndex': 3,
+                    'dependencyTokenIndex': 0
+                },
+                {
+                    'relationship': 'cop',
+                    'governorTokenIndex': 3,
+                    'dependencyTokenIndex': 1
+                },
+                {
+                    'relationship': 'det',
+                    'governorTokenIndex': 3,
+                    'dependencyTokenIndex': 2
+                },
+                {
+                    'relationship': 'root',
+                    'governorTokenIndex': -1,
+                    'dependencyTokenIndex': 3
+                },
+                {
+                    'relationship': 'root',
+                    'governorTokenIndex': -1,
+                    'dependencyTokenIndex': 5
+                },
+                {
+                    'relationship': 'cop',
+                    'governorTokenIndex': 5,
+                    'dependencyTokenIndex': 6
+                },
+                {
+                    'relationship': 'nsubj',
+                    'governorTokenIndex': 5,
+                    'dependencyTokenIndex': 7
+                },
+                {
+                    'relationship': 'punct',
+                    'governorTokenIndex': 5,
+                    'dependencyTokenIndex': 8
+                },
+            ]
+        }
+    }
+}
+
+
+DIGRAPH = deps_to_graph.STYLE.join(['digraph G{', '''\
+0 [label="This"]
+1 [label="is"]
+2 [label="a"]
+3 [label="sentence"]
+4 [label="."]
+5 [label="So"]
+6 [label="is"]
+7 [label="this"]
+8 [label="."]
+-1 [label="S1"]
+-2 [label="S2"]
+-1 -> 3 [label="root"]
+-2 -> 5 [label="root"]
+3 -> 4 [label="punct"]
+3 -> 0 [label="nsubj"]
+3 -> 1 [label="cop"]
+3 -> 2 [label="det"]
+5 -> 6 [label="cop"]
+5 -> 7 [label="nsubj"]
+5 -> 8 [label="punct"]
+}
+'''])
+
+
+class FakeAPI(object):
+    """Stands in for rosette.api.API, recording the content it is sent"""
+
+    def __init__(self, output='rosette', concurrency=1):
+        self.service_url = deps_to_graph.DEFAULT_ROSETTE_API_URL
+        self.url_parameters = {'output': output}
+        self.options = {}
+        self.contents = []
+        self.parameters = []
+        self.concurrency = concurrency
+        self.max_pool_size = 1
+        self.lock = threading.Lock()
+        self.active = self.peak = 0
+
+    def ping(self):
+        # Like the SDK, only learn the concurrency limit from a response
+        self.max_pool_size = self.concurrency
+        return {'message': 'Rosette API at your service'}
+
+    def get_pool_size(self):
+        return self.max_pool_size
+
+    def syntax_dependencies(self, parameters):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        # Give other workers a chance to overlap with this request
+        time.sleep(0.01)
+        with self.lock:
+            self.active -= 1
+            self.contents.append(parameters['content'])
+            self.parameters.append(parameters)
+        return dict(
+            copy.deepcopy(ADM),
+            content=parameters['content'],
+            output=self.url_parameters['output']
+        )
+
+
+class TestGraph(unittest.TestCase):
+
+    def test_escape(self):
+        self.assertEqual(deps_to_graph.escape('a'), 'a')
+        self.assertEqual(
+            deps_to_graph.escape('[x](y)"z"\\'),
+            '\\[x\\]\\(y\\)\\"z\\"\\\\'
+        )
+
+    def test_dependencies_are_grouped_by_governor(self):
+        edges = deps_to_graph.dependencies(ADM)
+        self.assertEqual(
+            [edge['governorTokenIndex'] for edge in edges],
+            [-1, -1, 3, 3, 3, 3, 5, 5, 5]
+        )
+        # Edges keep their input order within a governor
+        self.assertEqual(
+            [edge['dependencyTokenIndex'] for edge in edges[2:6]],
+            [4, 0, 1, 2]
+        )
+
+    def test_tokens_are_sorted_by_offset(self):
+        self.assertEqual(
+            [token['startOffset'] for token in deps_to_graph.tokens(ADM)],
+            [0, 5, 8, 10, 18, 20, 23, 26, 30]
+        )
+
+    def test_deps_to_graph(self):
+        self.assertEqual(deps_to_graph.deps_to_graph(ADM), DIGRAPH)
+
+    def test_deps_to_graph_index_labels(self):
+        digraph = deps_to_graph.deps_to_graph(ADM, index_labels=True)
+        self.assertIn('0 [label="(0) This"]\n', digraph)
+        self.assertIn('8 [label="(8) ."]\n', digraph)
+
+    def test_deps_to_graph_does_not_modify_adm(self):
+        adm = copy.deepcopy(ADM)
+        deps_to_graph.deps_to_graph(adm)
+        self.assertEqual(adm, ADM)
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache_dir = deps_to_graph.CACHE_DIR
+        deps_to_graph.CACHE_DIR = directory.name
+
+    def tearDown(self):
+        deps_to_graph.CACHE_DIR = self.cache_dir
+
+    def request(self, api, content='text', **kwargs):
+        return deps_to_graph.request(
+            content, 'syntax_dependencies', api, **kwargs
+        )
+
+    def test_cache_is_off_by_default(self):
+        api = FakeAPI()
+        self.request(api)
+        self.request(api)
+        self.assertEqual(len(api.contents), 2)
+        self.assertEqual(os.listdir(deps_to_graph.CACHE_DIR), [])
+
+    def test_cache_hit(self):
+        api = FakeAPI()
+        first = self.request(api, cache=True)
+        second = self.request(api, cache=True)
+        self.assertEqual(first, second)
+        self.assertEqual(api.contents, ['text'])
+        self.request(api, content='other text', cache=True)
+        self.assertEqual(api.contents, ['text', 'other text'])
+
+    def test_cache_key_covers_api_setup(self):
+        plain_api, adm_api = FakeAPI(output='json'), FakeAPI()
+        plain = self.request(plain_api, cache=True)
+        adm = self.request(adm_api, cache=True)
+        self.assertEqual(plain['output'], 'json')
+        self.assertEqual(adm['output'], 'rosette')
+        self.assertEqual(len(adm_api.contents), 1)
+
+    def test_uris_are_not_cached(self):
+        api = FakeAPI()
+        self.request(api, content='http://example.com', uri=True, cache=True)
+        self.request(api, content='http://example.com', uri=True, cache=True)
+        self.assertEqual(len(api.contents), 2)
+        self.assertEqual(os.listdir(deps_to_graph.CACHE_DIR), [])
+
+    def test_request_many(self):
+        api = FakeAPI()
+        results = deps_to_graph.request_many(
+            ['one', 'two', 'three'], 'syntax_dependencies', api
+        )
+        self.assertEqual(api.contents, [])
+        self.assertEqual(next(results)['content'], 'one')
+        self.assertEqual(api.contents, ['one'])
+        self.assertEqual(
+            [result['content'] for result in results], ['two', 'three']
+        )
+        self.assertEqual(api.contents, ['one', 'two', 'three'])
+        parameters = api.parameters[0]
+        self.assertTrue(all(p is parameters for p in api.parameters))
+        self.assertIsNone(parameters['language'])
+
+    def test_request_many_language(self):
+        api = FakeAPI()
+        list(deps_to_graph.request_many(
+            ['one'], 'syntax_dependencies', api, language='eng'
+        ))
+        self.assertEqual(api.parameters[0]['language'], 'eng')
+
+    def test_pickle_cache_reuses_json_entry(self):
+        api = FakeAPI()
+        expected = self.request(api, cache=True)
+        result = self.request(api, cache=True, cache_format='pickle')
+        self.assertEqual(result, expected)
+        self.assertEqual(len(api.contents), 1)
+        names = os.listdir(deps_to_graph.CACHE_DIR)
+        self.assertEqual(
+            sorted(os.path.splitext(name)[1] for name in names),
+            ['.json', '.pickle']
+        )
+        self.assertEqual(
+            self.request(api, cache=True, cache_format='pickle'), expected
+        )
+        self.assertEqual(len(api.contents), 1)
+
+    def test_corrupt_entry_is_a_miss(self):
+        api = FakeAPI()
+        self.request(api, cache=True, cache_format='pickle')
+        for name in os.listdir(deps_to_graph.CACHE_DIR):
+            path = os.path.join(deps_to_graph.CACHE_DIR, name)
+            with open(path, mode='wb') as f:
+                f.write(b'\x80\x05not a pickle')
+        self.request(api, cache=True, cache_format='pickle')
+        self.assertEqual(len(api.contents), 2)
+
+
+class TestContent(unittest.TestCase):
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'input.txt')
+            with open(path, mode='wb') as f:
+                f.write('Café\r\nis\rnice.\n'.encode('utf-8'))
+            self.assertEqual(
+                deps_to_graph.get_content(path),
+                'Café\nis\nnice.\n'
+            )
+
+    def test_stdin(self):
+        stdin = io.TextIOWrapper(io.BytesIO('Café\r\n'.encode('utf-8')))
+        with mock.patch('sys.stdin', stdin):
+            self.assertEqual(deps_to_graph.get_content(None), 'Café\n')
+
+    def test_parse_uploads_large_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            small = os.path.join(directory, 'small.txt')
+            large = os.path.join(directory, 'large.txt')
+            with open(small, mode='wb') as f:
+                f.write(b'Hi.\r\n')
+            with open(large, mode='wb') as f:
+                f.write(b'Hello there.\r\n')
+            with mock.patch.object(deps_to_graph, 'UPLOAD_THRESHOLD', 8):
+                self.assertFalse(deps_to_graph.is_upload(small))
+                self.assertTrue(deps_to_graph.is_upload(large))
+                self.assertFalse(deps_to_graph.is_upload(large, uri=True))
+                self.assertFalse(deps_to_graph.is_upload(None))
+                api = FakeAPI()
+                deps_to_graph.parse(small, api)
+                deps_to_graph.parse(large, api)
+        # Uploaded files are sent as is rather than decoded
+        self.assertEqual(api.contents, ['Hi.\n', b'Hello there.\r\n'])
+
+    def test_batch_inputs(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ('b.txt', 'a.txt', 'a.txt.svg', '.DS_Store'):
+                open(os.path.join(directory, name), mode='w').close()
+            os.mkdir(os.path.join(directory, 'subdirectory'))
+            self.assertEqual(
+                deps_to_graph.batch_inputs(directory),
+                [os.path.join(directory, 'a.txt'),
+                 os.path.join(directory, 'b.txt')]
+            )
+
+    def test_dump(self):
+        stdout = io.TextIOWrapper(io.BytesIO())
+        with mock.patch('sys.stdout', stdout):
+            deps_to_graph.dump(b'<svg>\xc3\xa9</svg>\n', None)
+        self.assertEqual(stdout.buffer.getvalue(), b'<svg>\xc3\xa9</svg>\n')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'output.svg')
+            deps_to_graph.dump('<svg>é</svg>\n', path)
+            with open(path, mode='rb') as f:
+                self.assertEqual(f.read(), b'<svg>\xc3\xa9</svg>\n')
+
+    def test_uri_quoting(self):
+        get_content = deps_to_graph.get_content
+        self.assertEqual(
+            get_content('www.example.com/a-b_c', uri=True),
+            'www.example.com/a-b_c'
+        )
+        self.assertEqual(
+            get_content('http://example.com/é f?q=1', uri=True),
+            'http://example.com/%C3%A9%20f%3Fq%3D1'
+        )
+        self.assertEqual(
+            get_content('http://example.com/a%20b', uri=True),
+            'http://example.com/a%20b'
+        )
+
+
+# Render digraphs without dot, so that batches can be tested without it
+@mock.patch.object(
+    deps_to_graph.DotPool, 'render', lambda self, digraph: digraph.encode()
+)
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache_dir = os.path.join(directory.name, 'cache')
+        self.paths = []
+        for i in range(6):
+            path = os.path.join(directory.name, '{}.txt'.format(i))
+            with open(path, mode='w') as f:
+                f.write('Document {}.'.format(i))
+            self.paths.append(path)
+
+    def test_results_are_in_order(self):
+        api = FakeAPI(concurrency=4)
+        results = list(deps_to_graph.render_batch(self.paths, api, workers=3))
+        self.assertEqual([path for path, _ in results], self.paths)
+        self.assertEqual(
+            [svg for _, svg in results],
+            [DIGRAPH.encode()] * len(self.paths)
+        )
+
+    def test_workers_are_capped_at_account_concurrency(self):
+        api = FakeAPI(concurrency=2)
+        list(deps_to_graph.render_batch(self.paths, api, workers=8))
+        self.assertEqual(api.peak, 2)
+
+    def test_concurrency_is_learned_before_cached_inputs(self):
+        render_batch = deps_to_graph.render_batch
+        with mock.patch.object(deps_to_graph, 'CACHE_DIR', self.cache_dir):
+            # Cache the first input, so that it makes no request next time
+            list(render_batch(self.paths[:1], FakeAPI(), cache=True))
+            api = FakeAPI(concurrency=2)
+            list(render_batch(self.paths, api, workers=8, cache=True))
+        self.assertEqual(api.peak, 2)
+
+    def test_failure_cancels_pending_requests(self):
+        with open(self.paths[1], mode='wb') as f:
+            f.write(b'\xff not UTF-8')
+        api = FakeAPI()
+        with self.assertRaises(UnicodeDecodeError):
+            list(deps_to_graph.render_batch(self.paths, api))
+        # The document after the failing one may already have started, but
+        # none of the rest are requested
+        self.assertLessEqual(len(api.contents), 2)
+
+
+@unittest.skipIf(shutil.which('dot') is None, 'dot is not installed')
+class TestDot(unittest.TestCase):
+
+    def assertSVG(self, svg):
+        self.assertTrue(svg.startswith(b'<?xml'))
+        self.assertTrue(svg.rstrip().endswith(b'</svg>'))
+
+    def test_renderer_round_trip(self):
+        digraph = deps_to_graph.deps_to_graph(ADM)
+        expected = deps_to_graph.make_svg(digraph)
+        self.assertSVG(expected)
+        with deps_to_graph.DotRenderer() as renderer:
+            svgs = [renderer.render(digraph) for _ in range(3)]
+        self.assertEqual(svgs, [expected] * 3)
+
+    def test_renderer_failure(self):
+        with deps_to_graph.DotRenderer() as renderer:
+            with self.assertRaises(Exception):
+                renderer.render('digraph G{ -> }\n')
+
+    def test_pool(self):
+        digraph = deps_to_graph.deps_to_graph(ADM)
+        expected = deps_to_graph.make_svg(digraph)
+        with deps_to_graph.DotPool() as pool:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                svgs = list(executor.map(pool.render, [digraph] * 8))
+            self.assertLessEqual(len(pool.renderers), 4)
+        self.assertEqual(svgs, [expected] * 8)
+        self.assertEqual(pool.renderers, [])
+
+
+if __name__ == '__main__':
+    unittest.main()